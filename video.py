@@ -1,16 +1,23 @@
+import atexit
+import hashlib
+import http.cookiejar
+import shutil
+import subprocess
 import tempfile
+import threading
 import time
-import yt_dlp as ytdl
 import os
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from pathlib import Path
 import streamlit as st
 from phi.agent import Agent
 from phi.model.google import Gemini
-from phi.tools.duckduckgo import DuckDuckGo
 from google.generativeai import upload_file, get_file
 import google.generativeai as genai
 from dotenv import load_dotenv
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 
 load_dotenv()
 
@@ -42,17 +49,310 @@ if "current_input" not in st.session_state:
     st.session_state.current_input = None
 if "last_uploaded_name" not in st.session_state:
     st.session_state.last_uploaded_name = None
+if "uploaded_files" not in st.session_state:
+    st.session_state.uploaded_files = {}
+if "video_digests" not in st.session_state:
+    st.session_state.video_digests = {}
+if "temp_dirs" not in st.session_state:
+    st.session_state.temp_dirs = []
+if "upload_temp_file" not in st.session_state:
+    st.session_state.upload_temp_file = None
 
 @st.cache_resource
-def initialize_agent():
+def initialize_agent(web_search=True):
+    tools = []
+    if web_search:
+        # Imported lazily so sessions without web search skip loading it
+        from phi.tools.duckduckgo import DuckDuckGo
+        tools.append(DuckDuckGo())
     return Agent(
         name="Video AI Summarizer",
         model=Gemini(id="gemini-2.5-flash"),
-        tools=[DuckDuckGo()],
+        tools=tools,
         markdown=True,
     )
 
-multimodal_Agent = initialize_agent()
+# Prefer MP4-native streams up to 720p so yt-dlp never re-encodes. Separate video and
+# audio tracks need ffmpeg for the stream-copy merge, so without it stick to single files.
+if shutil.which("ffmpeg"):
+    MP4_FORMAT = 'bv*[ext=mp4][height<=720]+ba[ext=m4a]/b[ext=mp4][height<=720]/b[ext=mp4]/b'
+else:
+    MP4_FORMAT = 'b[ext=mp4][height<=720]/b[ext=mp4]/b'
+
+@st.cache_data(ttl=3600, show_spinner=False)
+def list_playlist(playlist_url):
+    """Return (title, url) pairs for the playlist entries without downloading anything.
+
+    Cached for an hour so reruns triggered by other widgets don't query YouTube again.
+    """
+    import yt_dlp as ytdl
+
+    ydl_opts = {'extract_flat': True, 'skip_download': True, 'quiet': True}
+    with ytdl.YoutubeDL(ydl_opts) as ydl:
+        info = ydl.extract_info(playlist_url, download=False)
+    return [(entry.get('title') or entry['url'], entry['url'])
+            for entry in info.get('entries') or [] if entry and entry.get('url')]
+
+def file_digest(path, block_size=1 << 20):
+    """Return the SHA-256 hex digest of a file, read in 1 MiB blocks."""
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(block_size), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+@st.cache_resource
+def transcode_slots():
+    """Process-wide cap on concurrent ffmpeg encodes; each one already spreads over several cores."""
+    return threading.BoundedSemaphore(2)
+
+def transcode_for_upload(path, timeout=1800):
+    """Shrink a video to 720p at 1 fps for Gemini, which only samples about one frame per second.
+
+    Returns the original path if ffmpeg is unavailable, fails, times out, or doesn't
+    make the file smaller.
+    """
+    if not shutil.which("ffmpeg"):
+        return path
+    output = str(Path(path).with_suffix(".gemini.mp4"))
+    threads = max(1, (os.cpu_count() or 2) // 2)
+    try:
+        with transcode_slots():
+            # -nostdin and DEVNULL keep ffmpeg off the server's terminal, where it would
+            # eat keystrokes or stop on SIGTTIN when the server runs in the background
+            result = subprocess.run(
+                ["ffmpeg", "-nostdin", "-y", "-loglevel", "error", "-i", str(path),
+                 "-vf", "scale=-2:'min(720,ih)'", "-r", "1",
+                 "-c:v", "libx264", "-preset", "veryfast", "-crf", "30", "-threads", str(threads),
+                 "-c:a", "aac", "-b:a", "64k", output],
+                stdin=subprocess.DEVNULL,
+                capture_output=True,
+                timeout=timeout,
+            )
+        transcoded = result.returncode == 0 and video_size(output) < video_size(path)
+    except subprocess.TimeoutExpired:
+        transcoded = False
+    if not transcoded:
+        Path(output).unlink(missing_ok=True)
+        return path
+    return output
+
+def upload_video(path, digest, uploaded_files):
+    """Return (digest, Gemini file) for path, reusing the upload recorded in uploaded_files if still valid.
+
+    digest is the file's content digest if already known; otherwise it is computed here.
+    """
+    digest = digest or file_digest(path)
+    video = None
+    if digest in uploaded_files:
+        try:
+            video = get_file(uploaded_files[digest])
+        except Exception:
+            # Expired or deleted on the Gemini side
+            video = None
+        if video is not None and video.state.name == "FAILED":
+            video = None
+    if video is None:
+        upload_path = transcode_for_upload(path)
+        try:
+            video = upload_file(upload_path)
+        finally:
+            if upload_path != path:
+                Path(upload_path).unlink(missing_ok=True)
+    return digest, video
+
+def upload_videos(video_paths, video_digests, uploaded_files, max_delay=10):
+    """Upload videos to Gemini concurrently and wait until none is still PROCESSING.
+
+    video_digests maps local paths to content digests, and uploaded_files maps
+    digests to Gemini file names; videos found there are reused instead of being
+    uploaded again.
+    """
+    with ThreadPoolExecutor(max_workers=min(8, len(video_paths))) as executor:
+        futures = [executor.submit(upload_video, path, video_digests.get(path), uploaded_files)
+                   for path in video_paths]
+
+        # Record every upload that finished before re-raising a failure, so none is orphaned
+        videos = []
+        error = None
+        for path, future in zip(video_paths, futures):
+            try:
+                digest, video = future.result()
+            except Exception as e:
+                error = error or e
+                continue
+            video_digests[path] = digest
+            uploaded_files[digest] = video.name
+            videos.append(video)
+        if error is not None:
+            raise error
+
+        # Processing time grows with video length, so back off instead of polling every second
+        delay = 0.2
+        while True:
+            pending = [i for i, video in enumerate(videos) if video.state.name == "PROCESSING"]
+            if not pending:
+                return videos
+            time.sleep(delay)
+            delay = min(delay * 2, max_delay)
+            refreshed = executor.map(get_file, [videos[i].name for i in pending])
+            for i, video in zip(pending, refreshed):
+                videos[i] = video
+
+def download_and_upload_videos(video_urls, ydl_opts, video_digests, uploaded_files, max_workers=4):
+    """Download videos concurrently, starting each Gemini upload as soon as its download finishes.
+
+    Returns the local paths in the order of video_urls. Digests and uploads are
+    recorded in video_digests and uploaded_files so the analysis step can reuse them.
+    """
+    import yt_dlp as ytdl
+
+    def download_entry(video_url):
+        with ytdl.YoutubeDL(ydl_opts) as ydl:
+            info = ydl.extract_info(video_url, download=True)
+            downloads = info.get('requested_downloads') or [{}]
+            return downloads[0].get('filepath') or ydl.prepare_filename(info)
+
+    paths = {}
+    upload_futures = []
+    download_executor = ThreadPoolExecutor(max_workers=max_workers)
+    upload_executor = ThreadPoolExecutor(max_workers=max_workers)
+    try:
+        download_futures = {download_executor.submit(download_entry, url): url for url in video_urls}
+        for future in as_completed(download_futures):
+            # result() re-raises the first download error, if any
+            path = future.result()
+            paths[download_futures[future]] = path
+            upload_futures.append(
+                (path, upload_executor.submit(upload_video, path, None, uploaded_files))
+            )
+    finally:
+        # On a failed download, drop queued downloads and uploads instead of waiting for them
+        download_executor.shutdown(wait=False, cancel_futures=True)
+        upload_executor.shutdown(cancel_futures=True)
+        # Record every upload that did finish, so no Gemini file is left orphaned
+        for path, future in upload_futures:
+            if future.cancelled() or future.exception() is not None:
+                # Not fatal: upload_videos retries at analysis time
+                continue
+            digest, video = future.result()
+            video_digests[path] = digest
+            uploaded_files[digest] = video.name
+
+    return [paths[url] for url in video_urls]
+
+@st.cache_resource
+def get_http_session():
+    """Shared session so range workers and reruns reuse pooled keep-alive connections."""
+    session = requests.Session()
+    # Shared by every browser session in the process, so never store cookies
+    session.cookies.set_policy(http.cookiejar.DefaultCookiePolicy(allowed_domains=[]))
+    adapter = HTTPAdapter(
+        pool_connections=16,
+        pool_maxsize=16,
+        max_retries=Retry(total=3, backoff_factor=0.3),
+    )
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    return session
+
+def download_direct(url, destination, num_chunks=8, chunk_size=1 << 20):
+    """Download url to destination, fetching byte ranges in parallel when the server allows it."""
+    session = get_http_session()
+    # Byte ranges refer to the encoded body, so ask for it uncompressed
+    identity = {'Accept-Encoding': 'identity'}
+    try:
+        head = session.head(url, headers=identity, allow_redirects=True, timeout=10)
+    except requests.RequestException:
+        # Some servers reset or stall on HEAD; the plain GET below still works for them
+        head = None
+    total_size = int(head.headers.get('Content-Length') or 0) if head is not None else 0
+    supports_ranges = (head is not None and head.ok and
+                       head.headers.get('Accept-Ranges', '').lower() == 'bytes')
+
+    if supports_ranges and total_size > chunk_size and hasattr(os, 'pwrite'):
+        part_size = -(-total_size // num_chunks)
+        ranges = [(start, min(start + part_size, total_size) - 1)
+                  for start in range(0, total_size, part_size)]
+
+        fd = os.open(destination, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+        try:
+            if hasattr(os, 'posix_fallocate'):
+                # Reserve all blocks up front so the parallel writes don't fragment the file
+                os.posix_fallocate(fd, 0, total_size)
+            else:
+                os.ftruncate(fd, total_size)
+
+            def fetch_range(byte_range):
+                start, end = byte_range
+                with session.get(url, headers={**identity, 'Range': f'bytes={start}-{end}'},
+                                 stream=True, timeout=45) as response:
+                    response.raise_for_status()
+                    if response.status_code != 206:
+                        # Server ignored the Range header; use the sequential path instead
+                        return False
+                    offset = start
+                    while chunk := response.raw.read(chunk_size):
+                        os.pwrite(fd, chunk, offset)
+                        offset += len(chunk)
+                if offset != end + 1:
+                    raise IOError(f"Incomplete download of bytes {start}-{end}")
+                return True
+
+            with ThreadPoolExecutor(max_workers=len(ranges)) as executor:
+                ranged = all(list(executor.map(fetch_range, ranges)))
+        finally:
+            os.close(fd)
+        if ranged:
+            return
+
+    with session.get(url, stream=True, timeout=45) as response:
+        response.raise_for_status()
+        response.raw.decode_content = True
+        with open(destination, "wb") as f:
+            shutil.copyfileobj(response.raw, f, length=chunk_size)
+
+@st.cache_resource
+def temp_dir_registry():
+    """Every download dir still alive in this process; whatever is left is removed at exit."""
+    temp_dirs = set()
+
+    def remove_all():
+        for temp_dir in temp_dirs:
+            shutil.rmtree(temp_dir, ignore_errors=True)
+
+    atexit.register(remove_all)
+    return temp_dirs
+
+def clear_temp_dirs():
+    """Delete the download dirs created by this session."""
+    registry = temp_dir_registry()
+    for temp_dir in st.session_state.temp_dirs:
+        shutil.rmtree(temp_dir, ignore_errors=True)
+        registry.discard(temp_dir)
+    st.session_state.temp_dirs = []
+
+def close_upload_temp_file():
+    """Close the session's uploaded-video temp file, which also deletes it."""
+    if st.session_state.upload_temp_file is not None:
+        st.session_state.upload_temp_file.close()
+        st.session_state.upload_temp_file = None
+
+def new_temp_dir():
+    """Create a download dir for a new input, replacing the session's previous files."""
+    clear_temp_dirs()
+    close_upload_temp_file()
+    temp_dir = tempfile.mkdtemp()
+    st.session_state.temp_dirs.append(temp_dir)
+    temp_dir_registry().add(temp_dir)
+    return temp_dir
+
+def video_size(path):
+    """Return the file size in bytes, or 0 if it is missing, using a single stat call."""
+    try:
+        return os.stat(path).st_size
+    except OSError:
+        return 0
 
 # Choose input method
 video_option = st.selectbox(
@@ -79,10 +379,17 @@ if video_option == "Upload Video":
         # Only re-process if it's a new file
         if (st.session_state.last_uploaded_name != video_file.name or
                 not st.session_state.video_paths):
-            with tempfile.NamedTemporaryFile(delete=False, suffix='.mp4') as temp_video:
-                temp_video.write(video_file.read())
-                st.session_state.video_paths = [temp_video.name]
-                st.session_state.last_uploaded_name = video_file.name
+            close_upload_temp_file()
+            clear_temp_dirs()
+            # Kept open in the session instead of delete=False, so the file is removed
+            # when it is replaced, cleared, or the session is garbage collected
+            temp_video = tempfile.NamedTemporaryFile(suffix='.mp4')
+            shutil.copyfileobj(video_file, temp_video, length=1 << 20)
+            temp_video.flush()
+            st.session_state.upload_temp_file = temp_video
+            st.session_state.video_paths = [temp_video.name]
+            st.session_state.video_digests[temp_video.name] = file_digest(temp_video.name)
+            st.session_state.last_uploaded_name = video_file.name
             st.success("Video uploaded successfully!")
         if st.session_state.video_paths:
             st.video(st.session_state.video_paths[0], format="video/mp4")
@@ -94,29 +401,31 @@ elif video_option == "Provide YouTube Link":
         key="youtube_single"
     )
     if youtube_url:
-        # Download only if URL changed or no valid file exists
-        if (st.session_state.current_input != youtube_url or
-                not st.session_state.video_paths or
-                not Path(st.session_state.video_paths[0]).exists()):
+        # Download only if URL changed or no valid file exists; the stat is reused for the preview
+        video_ready = (bool(st.session_state.video_paths) and
+                       video_size(st.session_state.video_paths[0]) > 0)
+        if st.session_state.current_input != youtube_url or not video_ready:
 
             with st.spinner("Downloading YouTube video..."):
                 try:
-                    temp_dir = tempfile.mkdtemp()
+                    # Imported here: loading every yt-dlp extractor takes seconds
+                    import yt_dlp as ytdl
+
+                    temp_dir = new_temp_dir()
                     video_filename = Path(temp_dir) / "youtube_video.mp4"
 
                     ydl_opts = {
-                        'format': 'mp4',
+                        'format': MP4_FORMAT,
+                        'merge_output_format': 'mp4',
                         'outtmpl': str(video_filename),
-                        'postprocessors': [{
-                            'key': 'FFmpegVideoConvertor',
-                            'preferedformat': 'mp4',
-                        }],
                     }
                     with ytdl.YoutubeDL(ydl_opts) as ydl:
                         ydl.extract_info(youtube_url, download=True)
 
-                    if video_filename.exists() and video_filename.stat().st_size > 10000:
+                    video_ready = video_size(video_filename) > 10000
+                    if video_ready:
                         st.session_state.video_paths = [str(video_filename)]
+                        st.session_state.video_digests[str(video_filename)] = file_digest(video_filename)
                         st.session_state.current_input = youtube_url
                         st.success("Video downloaded!")
                     else:
@@ -125,9 +434,10 @@ elif video_option == "Provide YouTube Link":
                 except Exception as e:
                     st.error(f"Download failed: {e}")
                     st.session_state.video_paths = []
+                    video_ready = False
 
         # Show video
-        if st.session_state.video_paths and Path(st.session_state.video_paths[0]).exists():
+        if video_ready:
             st.video(st.session_state.video_paths[0], format="video/mp4")
 
 elif video_option == "Provide YouTube Playlist Link":
@@ -137,27 +447,44 @@ elif video_option == "Provide YouTube Playlist Link":
         key="youtube_playlist"
     )
     if playlist_url:
-        if (st.session_state.current_input != playlist_url or
-                not st.session_state.video_paths):
-
-            with st.spinner("Downloading playlist videos..."):
+        try:
+            with st.spinner("Fetching playlist entries..."):
+                entries = list_playlist(playlist_url)
+        except Exception as e:
+            st.error(f"Could not read playlist: {e}")
+            entries = []
+
+        titles = {url: title for title, url in entries}
+        selected_urls = st.multiselect(
+            "Choose videos to analyze",
+            options=list(titles),
+            default=list(titles),
+            format_func=titles.get,
+            key="playlist_selection"
+        )
+        selection = (playlist_url, tuple(selected_urls))
+
+        if (st.button("Download selected videos", disabled=not selected_urls) and
+                (st.session_state.current_input != selection or
+                 not st.session_state.video_paths)):
+
+            with st.spinner(f"Downloading and uploading {len(selected_urls)} playlist video(s)..."):
                 try:
-                    temp_dir = tempfile.mkdtemp()
+                    temp_dir = new_temp_dir()
                     ydl_opts = {
-                        'format': 'mp4',
-                        'outtmpl': str(Path(temp_dir) / '%(title)s.%(ext)s'),
-                        'postprocessors': [{
-                            'key': 'FFmpegVideoConvertor',
-                            'preferedformat': 'mp4',
-                        }],
+                        'format': MP4_FORMAT,
+                        'merge_output_format': 'mp4',
+                        'outtmpl': str(Path(temp_dir) / '%(title)s [%(id)s].%(ext)s'),
                     }
-                    with ytdl.YoutubeDL(ydl_opts) as ydl:
-                        ydl.extract_info(playlist_url, download=True)
+                    paths = download_and_upload_videos(
+                        selected_urls, ydl_opts,
+                        st.session_state.video_digests, st.session_state.uploaded_files
+                    )
 
-                    files = list(Path(temp_dir).glob('*.mp4'))
+                    files = [path for path in paths if path.endswith('.mp4')]
                     if files:
-                        st.session_state.video_paths = [str(f) for f in files]
-                        st.session_state.current_input = playlist_url
+                        st.session_state.video_paths = files
+                        st.session_state.current_input = selection
                         st.success(f"Downloaded {len(files)} video(s)")
                     else:
                         st.error("No .mp4 files were downloaded.")
@@ -178,25 +505,22 @@ elif video_option == "Provide direct video URL (.mp4)":
         key="direct_url"
     )
     if direct_url:
-        if (st.session_state.current_input != direct_url or
-                not st.session_state.video_paths or
-                not Path(st.session_state.video_paths[0]).exists()):
+        # Stat the current file once per rerun and reuse the result for the preview below
+        video_ready = (bool(st.session_state.video_paths) and
+                       video_size(st.session_state.video_paths[0]) > 0)
+        if st.session_state.current_input != direct_url or not video_ready:
 
             with st.spinner("Downloading video from URL..."):
                 try:
-                    temp_dir = tempfile.mkdtemp()
+                    temp_dir = new_temp_dir()
                     video_filename = Path(temp_dir) / "direct_video.mp4"
 
-                    response = requests.get(direct_url, stream=True, timeout=45)
-                    response.raise_for_status()
-
-                    with open(video_filename, "wb") as f:
-                        for chunk in response.iter_content(chunk_size=8192):
-                            if chunk:
-                                f.write(chunk)
+                    download_direct(direct_url, video_filename)
 
-                    if video_filename.exists() and video_filename.stat().st_size > 10000:
+                    video_ready = video_size(video_filename) > 10000
+                    if video_ready:
                         st.session_state.video_paths = [str(video_filename)]
+                        st.session_state.video_digests[str(video_filename)] = file_digest(video_filename)
                         st.session_state.current_input = direct_url
                         st.success("Video downloaded!")
                     else:
@@ -205,8 +529,9 @@ elif video_option == "Provide direct video URL (.mp4)":
                 except Exception as e:
                     st.error(f"Download failed: {e}")
                     st.session_state.video_paths = []
+                    video_ready = False
 
-        if st.session_state.video_paths and Path(st.session_state.video_paths[0]).exists():
+        if video_ready:
             st.video(st.session_state.video_paths[0], format="video/mp4")
 
 # ────────────────────────────────────────────────
@@ -218,6 +543,7 @@ user_query = st.text_area(
     placeholder="Ask anything about the video content...",
     height=120
 )
+web_search = st.checkbox("Allow the agent to search the web (DuckDuckGo)", value=True)
 
 if st.button("🔍 Analyze Video(s)", key="analyze_button"):
     if not user_query.strip():
@@ -227,16 +553,16 @@ if st.button("🔍 Analyze Video(s)", key="analyze_button"):
     else:
         try:
             with st.spinner("Processing video(s) and generating insights..."):
-                processed_videos = []
+                video_paths = []
                 for path in st.session_state.video_paths:
                     if not Path(path).exists():
                         st.warning(f"Video file no longer exists: {path}")
                         continue
-                    uploaded = upload_file(path)
-                    while uploaded.state.name == "PROCESSING":
-                        time.sleep(1)
-                        uploaded = get_file(uploaded.name)
-                    processed_videos.append(uploaded)
+                    video_paths.append(path)
+
+                processed_videos = (upload_videos(video_paths, st.session_state.video_digests,
+                                                  st.session_state.uploaded_files)
+                                    if video_paths else [])
 
                 if not processed_videos:
                     st.error("No valid videos could be uploaded for analysis.")
@@ -248,6 +574,7 @@ Analyze the uploaded videos and respond to the following query using insights fr
 Provide a detailed, user-friendly, and actionable response based on the content of the videos.
 """
 
+                    multimodal_Agent = initialize_agent(web_search)
                     response = multimodal_Agent.run(analysis_prompt, videos=processed_videos)
 
                     st.subheader("Analysis Result")
@@ -258,7 +585,10 @@ Provide a detailed, user-friendly, and actionable response based on the content
 
 # Optional: Reset button
 if st.button("Clear current video(s) and start over"):
+    clear_temp_dirs()
+    close_upload_temp_file()
     st.session_state.video_paths = []
+    st.session_state.video_digests = {}
     st.session_state.current_input = None
     st.session_state.last_uploaded_name = None
     st.rerun()